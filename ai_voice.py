@@ -1,25 +1,54 @@
 import os
-from gtts import gTTS
+import wave
+import threading
+from pathlib import Path
+from piper import PiperVoice
+from piper.download_voices import download_voice
 import platform
 import subprocess
+from dotenv import load_dotenv
+load_dotenv()
 
-def text_to_speech_with_gtts(input_text, output_filepath):
-    language="en"
+# Piper voice: either a voice name, downloaded into PIPER_VOICES_DIR on first use,
+# or a path to an .onnx model with its .onnx.json config next to it
+PIPER_VOICE=os.getenv("PIPER_VOICE", "en_US-lessac-medium")
+PIPER_VOICES_DIR=os.getenv("PIPER_VOICES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "voices"))
 
-    audioobj= gTTS(
-        text=input_text,
-        lang=language,
-        slow=False
-    )
-    audioobj.save(output_filepath)
+def piper_voice_path():
+    if PIPER_VOICE.endswith(".onnx"):
+        return PIPER_VOICE
+    model_path = os.path.join(PIPER_VOICES_DIR, f"{PIPER_VOICE}.onnx")
+    if not (os.path.exists(model_path) and os.path.exists(f"{model_path}.json")):
+        Path(PIPER_VOICES_DIR).mkdir(parents=True, exist_ok=True)
+        download_voice(PIPER_VOICE, Path(PIPER_VOICES_DIR))
+    return model_path
+
+_piper_voice = None
+_piper_voice_lock = threading.Lock()
+
+def get_piper_voice():
+    global _piper_voice
+    with _piper_voice_lock:
+        if _piper_voice is None:
+            _piper_voice = PiperVoice.load(piper_voice_path())
+    return _piper_voice
+
+def text_to_speech_with_piper(input_text, output_filepath):
+    voice = get_piper_voice()
+    with wave.open(output_filepath, "wb") as wav_file:
+        voice.synthesize_wav(input_text, wav_file)
+    return output_filepath
+
+def play_audio(filepath):
+    """Play an audio file on the local speakers; blocks until playback ends"""
     os_name = platform.system()
     try:
         if os_name == "Darwin":  # macOS
-            subprocess.run(['afplay', output_filepath])
+            subprocess.run(['afplay', filepath])
         elif os_name == "Windows":  # Windows
-            subprocess.run(['powershell', '-c', f'(New-Object Media.SoundPlayer "{output_filepath}").PlaySync();'])
+            subprocess.run(['powershell', '-c', f'(New-Object Media.SoundPlayer "{filepath}").PlaySync();'])
         elif os_name == "Linux":  # Linux
-            subprocess.run(['aplay', output_filepath])  # Alternative: use 'mpg123' or 'ffplay'
+            subprocess.run(['aplay', filepath])
         else:
             raise OSError("Unsupported operating system")
     except Exception as e:
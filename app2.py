@@ -1,8 +1,16 @@
 import os
+import asyncio
 import gradio as gr
 from dotenv import load_dotenv
-import datetime
+import time
+import glob
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
 
 load_dotenv()
 
@@ -10,8 +18,9 @@ GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 
 # Import your existing functions
 from brain import encode_image, analyze_image_with_query
-from patient_voice import record_audio, transcribe_with_groq
-from ai_voice import text_to_speech_with_gtts
+from patient_voice import record_audio, transcribe_audio, STT_BACKEND, get_local_stt_pipeline
+from ai_voice import text_to_speech_with_piper, get_piper_voice
+from response_cache import image_phash, lookup_response, store_response, get_embedder
 
 # System prompt
 SYSTEM_PROMPT = """
@@ -31,104 +40,262 @@ Example: "With what I see, I think you may have... I recommend..."
 OUTPUT_DIR = "doctor_responses"
 Path(OUTPUT_DIR).mkdir(exist_ok=True)
 
-def save_doctor_response(text_response, audio_path):
-    """Save doctor's response to a text file and preserve the audio file"""
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # Save text response
-    text_filename = f"{OUTPUT_DIR}/doctor_response_{timestamp}.txt"
+def response_timestamp():
+    return time.strftime("%Y%m%d_%H%M%S", time.localtime())
+
+def consultation_file_stem(image_hash, text_response):
+    """Name under which a consultation is saved, and whether it is already saved.
+
+    With an image, the name starts with its pHash and a digest of the response,
+    so saving the same consultation again reuses the existing files.
+    """
+    timestamp = response_timestamp()
+    if image_hash is None:
+        return timestamp, False
+    digest = hashlib.sha1(text_response.encode("utf-8")).hexdigest()[:12]
+    content_id = f"{image_hash}_{digest}"
+    existing = glob.glob(f"{OUTPUT_DIR}/doctor_response_{content_id}_*.txt")
+    if existing:
+        return Path(existing[0]).stem.removeprefix("doctor_response_"), True
+    return f"{content_id}_{timestamp}", False
+
+def write_text_response(text_response, text_filename):
     with open(text_filename, "w") as f:
         f.write(text_response)
-    
-    # Save audio file with new name
-    if audio_path and os.path.exists(audio_path):
-        new_audio_path = f"{OUTPUT_DIR}/doctor_voice_{timestamp}.mp3"
-        os.rename(audio_path, new_audio_path)
-        return new_audio_path
-    
-    return audio_path
+    return text_filename
+
+# Response files are written in the background so the response is not held up
+save_executor = ThreadPoolExecutor(max_workers=2)
+
+def report_save_error(future):
+    # Background saves have no caller to raise to, so at least log failures
+    error = future.exception()
+    if error is not None:
+        print(f"An error occurred while saving the consultation: {error}")
 
-def process_inputs(audio_filepath, image_filepath, save_response=False):
+def link_or_copy(src, dst):
     try:
-        speech_to_text_output = transcribe_with_groq(
-            audio_filepath=audio_filepath,
-            stt_model="whisper-large-v3"
+        # A hard link is atomic and copies no data when both are on the same filesystem
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def start_text_response_write(text_response, file_stem, save_response, download_dir, already_saved=False):
+    """Write the doctor's response to a text file in the background.
+
+    Saved consultations go to OUTPUT_DIR; otherwise the file goes to
+    download_dir, so the response can still be downloaded.
+    Returns the file path and the future.
+    """
+    text_dir = OUTPUT_DIR if save_response else download_dir
+    text_filename = f"{text_dir}/doctor_response_{file_stem}.txt"
+    if already_saved:
+        done = Future()
+        done.set_result(text_filename)
+        return text_filename, done
+    return text_filename, save_executor.submit(write_text_response, text_response, text_filename)
+
+def save_doctor_voice(audio_path, file_stem):
+    """Preserve the doctor's audio file in OUTPUT_DIR in the background.
+
+    Returns the future, or None if there is no audio to save.
+    """
+    if audio_path and os.path.exists(audio_path):
+        # The original is left in place since the UI is still serving it;
+        # it goes with the consultation's download_dir
+        saved = save_executor.submit(link_or_copy, audio_path, f"{OUTPUT_DIR}/doctor_voice_{file_stem}.wav")
+        saved.add_done_callback(report_save_error)
+        return saved
+    return None
+
+def hidden_downloads():
+    return gr.Group(visible=False), None, None
+
+def close_when_idle(iterator, pending_next):
+    """Close an iterator read through asyncio.to_thread once no next() call is running on it"""
+    loop = asyncio.get_running_loop()
+
+    def close(_=None):
+        if pending_next is not None and not pending_next.cancelled():
+            pending_next.exception()  # an error here is moot once we stop reading
+        if hasattr(iterator, "close"):
+            loop.run_in_executor(None, iterator.close)
+
+    if pending_next is None or pending_next.done():
+        close()
+    else:
+        pending_next.add_done_callback(close)
+
+async def prepare_image(image_filepath):
+    """Hash and encode the image; neither depends on the transcript"""
+    return await asyncio.gather(
+        asyncio.to_thread(image_phash, image_filepath),
+        asyncio.to_thread(encode_image, image_filepath)
+    )
+
+async def run_consultation(audio_filepath, image_filepath, save_response, download_dir):
+    """Yield the interface outputs as the consultation progresses; errors are raised"""
+    # Transcribe while the image is being hashed and encoded
+    stt_task = asyncio.to_thread(
+        transcribe_audio,
+        audio_filepath=audio_filepath,
+        stt_model="whisper-large-v3"
+    )
+    if image_filepath:
+        speech_to_text_output, (image_hash, encoded_image) = await asyncio.gather(
+            stt_task, prepare_image(image_filepath)
         )
+    else:
+        speech_to_text_output = await stt_task
+        image_hash = None
 
-        # Handle the image input
-        if image_filepath:
-            doctor_response = analyze_image_with_query(
-                query=SYSTEM_PROMPT + speech_to_text_output,
-                encoded_image=encode_image(image_filepath),
-                model="meta-llama/llama-4-scout-17b-16e-instruct"
+    # Handle the image input
+    streamed = False
+    if image_filepath:
+        # Reuse the answer for a similar image and description if we have one
+        doctor_response, transcript_embedding = await asyncio.to_thread(
+            lookup_response, image_hash, speech_to_text_output
+        )
+        if doctor_response is None:
+            response_chunks = await asyncio.to_thread(
+                analyze_image_with_query,
+                query=speech_to_text_output,
+                system_prompt=SYSTEM_PROMPT,
+                encoded_image=encoded_image,
+                model="meta-llama/llama-4-scout-17b-16e-instruct",
+                stream=True
+            )
+            # Show the response as it is generated
+            doctor_response = ""
+            pending_next = None
+            try:
+                while True:
+                    # Shielded so a cancelled request does not close the stream mid-read
+                    pending_next = asyncio.ensure_future(
+                        asyncio.to_thread(next, response_chunks, None)
+                    )
+                    chunk = await asyncio.shield(pending_next)
+                    if chunk is None:
+                        break
+                    if not doctor_response:
+                        yield speech_to_text_output, chunk, None, *hidden_downloads()
+                    else:
+                        yield gr.skip(), doctor_response + chunk, gr.skip(), gr.skip(), gr.skip(), gr.skip()
+                    doctor_response += chunk
+            finally:
+                close_when_idle(response_chunks, pending_next)
+            streamed = True
+            await asyncio.to_thread(
+                store_response, image_hash, speech_to_text_output, doctor_response,
+                transcript_embedding
             )
-        else:
-            doctor_response = "Please provide an image for medical analysis."
+    else:
+        doctor_response = "Please provide an image for medical analysis."
 
-        voice_of_doctor = text_to_speech_with_gtts(
-            input_text=doctor_response,
-            output_filepath="final.mp3"
+    # The text file is written while the voice is being synthesized
+    # Downloads are named after the consultation, like the saved files
+    file_stem, already_saved = response_timestamp(), False
+    if save_response:
+        # Looking for an earlier save scans OUTPUT_DIR, so keep it off the event loop
+        file_stem, already_saved = await asyncio.to_thread(
+            consultation_file_stem, image_hash, doctor_response
         )
+    text_filename, text_written = start_text_response_write(
+        doctor_response, file_stem, save_response, download_dir, already_saved
+    )
 
-        # Save response if requested
-        if save_response:
-            voice_of_doctor = save_doctor_response(doctor_response, voice_of_doctor)
-
-        return speech_to_text_output, doctor_response, voice_of_doctor
-    except Exception as e:
-        error_msg = f"An error occurred: {str(e)}"
-        return error_msg, error_msg, None
-
-# Custom CSS
-css = """
-.gradio-container {
-    font-family: 'Arial', sans-serif;
-}
-h1 {
-    color: #2d3748;
-    text-align: center;
-}
-.description {
-    text-align: center;
-    color: #4a5568;
-    margin-bottom: 20px;
-}
-.output-label {
-    font-weight: bold;
-    color: #2d3748;
-}
-.audio-container {
-    margin-top: 15px;
-}
-.error-message {
-    color: #e53e3e;
-    font-weight: bold;
-}
-.save-container {
-    margin-top: 20px;
-    padding: 15px;
-    background: #f7fafc;
-    border-radius: 8px;
-}
-"""
+    # Show the text right away (a streamed response is already shown);
+    # the voice follows once it is synthesized
+    if not streamed:
+        yield speech_to_text_output, doctor_response, None, *hidden_downloads()
+
+    # Each consultation gets its own audio file, so concurrent runs
+    # (e.g. a Submit while an example is being cached) do not overwrite it
+    voice_of_doctor = await asyncio.to_thread(
+        text_to_speech_with_piper,
+        input_text=doctor_response,
+        output_filepath=f"{download_dir}/doctor_voice_{file_stem}.wav"
+    )
+
+    # Save response if requested
+    voice_saved = None
+    if save_response and not already_saved:
+        voice_saved = save_doctor_voice(voice_of_doctor, file_stem)
+
+    await asyncio.wrap_future(text_written)
+    # Plain paths rather than DownloadButton updates, so the example cache
+    # copies both files into its own directory instead of storing temp paths
+    yield (
+        speech_to_text_output,
+        doctor_response,
+        voice_of_doctor,
+        gr.Group(visible=True),
+        text_filename,
+        voice_of_doctor
+    )
+
+    # Keep download_dir around until the saved copy of the voice exists;
+    # report_save_error already logs a failure
+    if voice_saved is not None:
+        await asyncio.wait([asyncio.wrap_future(voice_saved)])
+
+def error_outputs(error):
+    error_msg = f"An error occurred: {str(error)}"
+    return error_msg, error_msg, None, *hidden_downloads()
+
+async def process_inputs(audio_filepath, image_filepath, save_response=False):
+    # Gradio copies yielded files into its own cache, so the response and
+    # voice files are only needed until the final yield and are removed afterwards
+    with tempfile.TemporaryDirectory(prefix="doctor_response_") as download_dir:
+        try:
+            async for outputs in run_consultation(
+                audio_filepath, image_filepath, save_response, download_dir
+            ):
+                yield outputs
+        except Exception as e:
+            yield error_outputs(e)
+
+# The example cache stores the outputs only after the handler has finished,
+# so example responses are kept for the life of the process. Each example is
+# cached after its first run, which keeps this directory small.
+example_download_dir = tempfile.TemporaryDirectory(prefix="doctor_examples_")
 
-def find_available_port(start_port=7860, max_attempts=10):
-    import socket
-    for port in range(start_port, start_port + max_attempts):
+async def process_example(audio_filepath, image_filepath):
+    # Errors are raised rather than shown as outputs, so a failed run is
+    # not written to the example cache and replayed to later users
+    download_dir = tempfile.mkdtemp(dir=example_download_dir.name)
+    async for outputs in run_consultation(
+        audio_filepath, image_filepath, False, download_dir
+    ):
+        yield outputs
+
+def warmup():
+    """Load models before the first consultation"""
+    steps = [
+        ("Piper voice", get_piper_voice),
+        ("embedding model", get_embedder),
+    ]
+    if STT_BACKEND == "faster-whisper":
+        steps.append(("local STT model", get_local_stt_pipeline))
+    for name, step in steps:
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind(('', port))
-                return port
-        except OSError:
-            continue
-    return start_port
+            step()
+        except Exception as e:
+            print(f"Warmup of {name} failed: {e}")
+
+# Custom CSS, served as a static file so the browser can cache it
+# (css_paths would inline it into the page config on every load)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+CSS_PATH = os.path.join(STATIC_DIR, "app.css")
+gr.set_static_paths(paths=[STATIC_DIR])
+CSS_LINK = f'<link rel="stylesheet" href="gradio_api/file={quote(Path(CSS_PATH).as_posix())}">'
 
 # Create absolute paths to example files
 def get_example_path(filename):
     return os.path.join(os.path.dirname(__file__), "examples", filename)
 
 # Create the interface
-with gr.Blocks(css=css, theme=gr.themes.Soft()) as iface:
+with gr.Blocks(head=CSS_LINK, theme=gr.themes.Soft()) as iface:
     gr.Markdown("# 🩺 AI Doctor with Vision and Voice")
     gr.Markdown("Describe your symptoms while showing any affected area. Our AI doctor will analyze and respond.")
     
@@ -170,17 +337,20 @@ with gr.Blocks(css=css, theme=gr.themes.Soft()) as iface:
                 elem_classes="audio-container"
             )
             
-            # Add download buttons
+            # Add download buttons; process_inputs sets their files, so downloading needs no server call
             with gr.Group(visible=False) as save_group:
                 with gr.Row():
-                    download_text_btn = gr.Button("Download Text Response")
-                    download_audio_btn = gr.Button("Download Audio Response")
-                download_text_file = gr.File(visible=False)
-                download_audio_file = gr.File(visible=False)
+                    download_text_btn = gr.DownloadButton("Download Text Response")
+                    download_audio_btn = gr.DownloadButton("Download Audio Response")
             
             # Show saved confirmation
             save_confirmation = gr.Markdown("", visible=False)
     
+    consultation_outputs = [
+        speech_output, doctor_output, audio_output,
+        save_group, download_text_btn, download_audio_btn
+    ]
+    
     # Only add examples if the files exist
     example_files = [
         ["cough.wav", "skin_rash.jpg"],
@@ -198,65 +368,25 @@ with gr.Blocks(css=css, theme=gr.themes.Soft()) as iface:
         gr.Examples(
             examples=valid_examples,
             inputs=[audio_input, image_input],
-            outputs=[speech_output, doctor_output, audio_output],
-            fn=process_inputs,
-            cache_examples=False,
+            outputs=consultation_outputs,
+            fn=process_example,
+            cache_examples=True,
+            cache_mode="lazy",
             label="Try Example Consultations"
         )
     
-    # Show/hide download buttons based on response
-    def toggle_download_buttons(doctor_response):
-        if doctor_response and not doctor_response.startswith("An error occurred"):
-            return gr.Group(visible=True)
-        return gr.Group(visible=False)
-    
     # Process inputs when submit button is clicked
     submit_btn.click(
         fn=process_inputs,
         inputs=[audio_input, image_input, save_checkbox],
-        outputs=[speech_output, doctor_output, audio_output]
-    ).then(
-        fn=toggle_download_buttons,
-        inputs=doctor_output,
-        outputs=save_group
-    )
-    
-    # Handle download buttons
-    def download_text(doctor_response):
-        if doctor_response and not doctor_response.startswith("An error occurred"):
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"doctor_response_{timestamp}.txt"
-            # Create temporary file
-            temp_file = f"{OUTPUT_DIR}/{filename}"
-            with open(temp_file, "w") as f:
-                f.write(doctor_response)
-            return gr.File(value=temp_file, visible=True, label=filename)
-        return gr.File(visible=False)
-    
-    def download_audio(audio_file):
-        if audio_file and os.path.exists(audio_file):
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"doctor_voice_{timestamp}.mp3"
-            return gr.File(value=audio_file, visible=True, label=filename)
-        return gr.File(visible=False)
-    
-    # Connect download buttons to their functions
-    download_text_btn.click(
-        fn=download_text,
-        inputs=doctor_output,
-        outputs=download_text_file
-    )
-    
-    download_audio_btn.click(
-        fn=download_audio,
-        inputs=audio_output,
-        outputs=download_audio_file
+        outputs=consultation_outputs
     )
 
-# Find an available port
-available_port = find_available_port()
+# Warm up in the background so launching the interface is not delayed
+threading.Thread(target=warmup, daemon=True).start()
 
-# Launch with specific settings
+# Launch with specific settings; Gradio picks the port itself
+# (GRADIO_SERVER_PORT, or the first free port from 7860)
 iface.launch(
     debug=True,
     share=False
@@ -0,0 +1,28 @@
+import os
+import threading
+import httpx
+from groq import Groq
+from dotenv import load_dotenv
+load_dotenv()
+
+GROQ_API_KEY=os.getenv("GROQ_API_KEY")
+
+_groq_client = None
+_groq_client_lock = threading.Lock()
+
+def get_groq_client():
+    """
+    Shared Groq client for both speech-to-text and vision calls.
+
+    Both hit api.groq.com, so one pooled HTTP client lets a consultation
+    reuse the same keep-alive connection instead of a new TLS handshake per call.
+    """
+    global _groq_client
+    with _groq_client_lock:
+        if _groq_client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+            )
+            _groq_client = Groq(api_key=GROQ_API_KEY, http_client=http_client)
+    return _groq_client
@@ -1,13 +1,18 @@
 import speech_recognition as sr
 from pydub import AudioSegment
 import logging
-from groq import Groq
+from groq_client import get_groq_client
 from io import BytesIO
 import os
+import threading
 from dotenv import load_dotenv
 load_dotenv()
 
 GROQ_API_KEY=os.getenv("GROQ_API_KEY")
+# "groq" uses the Groq Whisper API, "faster-whisper" runs Whisper locally
+STT_BACKEND=os.getenv("STT_BACKEND", "groq")
+LOCAL_STT_MODEL=os.getenv("LOCAL_STT_MODEL", "large-v3")
+LOCAL_STT_COMPUTE_TYPE=os.getenv("LOCAL_STT_COMPUTE_TYPE", "auto")
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -46,13 +51,40 @@ def record_audio(file_path, timeout=2, phrase_time_limit=None):
 stt_model="whisper-large-v3"
 
 def transcribe_with_groq(stt_model, audio_filepath):
-    client=Groq()
+    client=get_groq_client()
     
-    audio_file=open(audio_filepath, "rb")
-    transcription=client.audio.transcriptions.create(
-        model=stt_model,
-        file=audio_file,
-        language="en"
-    )
+    with open(audio_filepath, "rb") as audio_file:
+        transcription=client.audio.transcriptions.create(
+            model=stt_model,
+            file=audio_file,
+            language="en"
+        )
 
     return transcription.text
+
+_local_stt_pipeline = None
+_local_stt_pipeline_lock = threading.Lock()
+
+def get_local_stt_pipeline():
+    global _local_stt_pipeline
+    with _local_stt_pipeline_lock:
+        if _local_stt_pipeline is None:
+            # Only needed for the local backend, so faster-whisper is imported lazily
+            from faster_whisper import WhisperModel, BatchedInferencePipeline
+            whisper_model = WhisperModel(LOCAL_STT_MODEL, device="auto", compute_type=LOCAL_STT_COMPUTE_TYPE)
+            _local_stt_pipeline = BatchedInferencePipeline(model=whisper_model)
+    return _local_stt_pipeline
+
+# One model instance serves every user, so concurrent requests take turns on it
+_local_stt_lock = threading.Lock()
+
+def transcribe_with_faster_whisper(audio_filepath, batch_size=8):
+    pipeline = get_local_stt_pipeline()
+    with _local_stt_lock:
+        segments, _ = pipeline.transcribe(audio_filepath, language="en", batch_size=batch_size)
+        return " ".join(segment.text.strip() for segment in segments)
+
+def transcribe_audio(stt_model, audio_filepath):
+    if STT_BACKEND == "faster-whisper":
+        return transcribe_with_faster_whisper(audio_filepath)
+    return transcribe_with_groq(stt_model, audio_filepath)
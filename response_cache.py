@@ -0,0 +1,95 @@
+import threading
+import numpy as np
+import imagehash
+from PIL import Image
+
+# Semantic cache for doctor responses.
+# An entry is reused when the image looks the same (close perceptual hash)
+# and the patient describes the same thing (close transcript embedding).
+# MiniLM is run through its ONNX export with onnxruntime, which the app already
+# needs, instead of sentence-transformers, which would pull in torch
+embedding_model = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_MAX_TOKENS = 256
+MAX_HASH_DISTANCE = 6
+MIN_SIMILARITY = 0.85
+MAX_ENTRIES = 512
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+_entries = []  # list of (image_hash, transcript_embedding, response)
+_entries_lock = threading.Lock()
+
+def get_embedder():
+    """Load the MiniLM tokenizer and ONNX model once; returns (tokenizer, session)"""
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            # Imported lazily so importing the app does not pay for them up front
+            import onnxruntime
+            from huggingface_hub import hf_hub_download
+            from tokenizers import Tokenizer
+            tokenizer = Tokenizer.from_file(hf_hub_download(embedding_model, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=EMBEDDING_MAX_TOKENS)
+            session = onnxruntime.InferenceSession(
+                hf_hub_download(embedding_model, "onnx/model.onnx"),
+                providers=["CPUExecutionProvider"]
+            )
+            _embedder = (tokenizer, session)
+    return _embedder
+
+def embed_text(text):
+    """Return the L2-normalized embedding of text, so a dot product is the cosine similarity"""
+    tokenizer, session = get_embedder()
+    encoding = tokenizer.encode(text)
+    attention_mask = np.array([encoding.attention_mask], dtype=np.int64)
+    feeds = {
+        "input_ids": np.array([encoding.ids], dtype=np.int64),
+        "attention_mask": attention_mask,
+        "token_type_ids": np.array([encoding.type_ids], dtype=np.int64),
+    }
+    model_inputs = {model_input.name: feeds[model_input.name] for model_input in session.get_inputs()}
+    token_embeddings = session.run(None, model_inputs)[0][0]
+
+    # Mean pooling over the real tokens, as sentence-transformers does for MiniLM
+    mask = attention_mask[0][:, None].astype(token_embeddings.dtype)
+    embedding = (token_embeddings * mask).sum(axis=0) / max(mask.sum(), 1e-9)
+    return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+def image_phash(image_path):
+    with Image.open(image_path) as image:
+        return imagehash.phash(image)
+
+def lookup_response(image_hash, transcript):
+    """
+    Look up a cached response for a similar image and transcript.
+
+    Returns (response, transcript_embedding). response is None on a miss;
+    transcript_embedding is None if no cached image was close enough to need it,
+    otherwise it can be passed on to store_response.
+    """
+    with _entries_lock:
+        candidates = [
+            (embedding, response)
+            for cached_hash, embedding, response in _entries
+            if image_hash - cached_hash <= MAX_HASH_DISTANCE
+        ]
+    if not candidates:
+        return None, None
+
+    query_embedding = embed_text(transcript)
+    embeddings = np.stack([embedding for embedding, _ in candidates])
+    similarities = embeddings @ query_embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] >= MIN_SIMILARITY:
+        return candidates[best][1], query_embedding
+    return None, query_embedding
+
+def store_response(image_hash, transcript, response, transcript_embedding=None):
+    if transcript_embedding is None:
+        transcript_embedding = embed_text(transcript)
+    entry = (image_hash, transcript_embedding, response)
+    with _entries_lock:
+        _entries.append(entry)
+        # Drop the oldest entries once the cache is full
+        del _entries[:-MAX_ENTRIES]